@@ -1,34 +1,155 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, current_app, request, jsonify, g
 from flask_cors import CORS
-from models import SessionLocal, CheckIn, Resource, Meal
+from models import CheckIn, Resource, Meal, data_version
+from profiles import ProfileRouter, ProfilePrefixMiddleware, PROFILE_ID
+from group_commit import InsertTimeout
 from datetime import date, timedelta
-from calendar import monthrange
-from sqlalchemy import and_
-
-app = Flask(__name__)
-# CORS: Allow localhost for dev, Render URLs for production
+from calendar import monthrange, isleap
+from sqlalchemy import and_, func, distinct
+import base64
 import os
-FRONTEND_URL = os.getenv('FRONTEND_URL', '')
-# In production, allow all origins (Render subdomains vary)
-# In development, restrict to localhost
-if os.getenv('FLASK_ENV') == 'production' or FRONTEND_URL:
-    # Production: allow all (Render will handle security)
-    CORS(app, resources={r"/api/*": {"origins": "*"}})
-else:
-    # Development: restrict to localhost
-    CORS(app, resources={r"/api/*": {"origins": [
-        "http://localhost:5173",
-        "http://localhost:5174", 
-        "http://localhost:3000",
-        "http://localhost:8080"
-    ]}})
-
-@app.get("/api/health")
+
+REPLICA_HEADERS = ["X-Read-Source", "X-Replica-Staleness"]
+
+api = Blueprint("api", __name__)
+
+def create_app(config=None):
+    """Build the Flask app. No database is opened until the first request.
+
+    `config` overrides the environment-derived defaults, e.g.
+    `create_app({"DATABASE_URL": "sqlite://"})` for an in-memory test app.
+    """
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE_URL=os.getenv('DATABASE_URL'),
+        # Read replica: READ_REPLICA=1 serves read-only handlers from an in-memory
+        # snapshot of the database. Send `X-Read-Primary: 1` to force a primary read.
+        READ_REPLICA=os.getenv('READ_REPLICA') == '1',
+        READ_REPLICA_INTERVAL=float(os.getenv('READ_REPLICA_INTERVAL', 2.0)),
+        READ_REPLICA_MAX_WRITES=int(os.getenv('READ_REPLICA_MAX_WRITES', 20)),
+        # Profiles: `X-Profile: <id>` or a `/p/<id>/api/...` prefix selects a
+        # per-profile SQLite file; requests without one use DATABASE_URL.
+        PROFILE_DIR=os.getenv('PROFILE_DIR', 'profiles'),
+        PROFILE_POOL_SIZE=int(os.getenv('PROFILE_POOL_SIZE', 64)),
+        PROFILE_IDLE_SECONDS=float(os.getenv('PROFILE_IDLE_SECONDS', 300)),
+        # Group commit: GROUP_COMMIT=1 batches check-in/meal inserts from
+        # concurrent requests into one transaction while the writer is busy.
+        GROUP_COMMIT=os.getenv('GROUP_COMMIT') == '1',
+        GROUP_COMMIT_MAX_BATCH=int(os.getenv('GROUP_COMMIT_MAX_BATCH', 64)),
+        GROUP_COMMIT_MAX_DELAY_MS=float(os.getenv('GROUP_COMMIT_MAX_DELAY_MS', 5)),
+    )
+    if config:
+        app.config.update(config)
+
+    # CORS: Allow localhost for dev, Render URLs for production
+    FRONTEND_URL = os.getenv('FRONTEND_URL', '')
+    # In production, allow all origins (Render subdomains vary)
+    # In development, restrict to localhost
+    if os.getenv('FLASK_ENV') == 'production' or FRONTEND_URL:
+        # Production: allow all (Render will handle security)
+        CORS(app, resources={r"/api/*": {"origins": "*"}}, expose_headers=REPLICA_HEADERS)
+    else:
+        # Development: restrict to localhost
+        CORS(app, resources={r"/api/*": {"origins": [
+            "http://localhost:5173",
+            "http://localhost:5174", 
+            "http://localhost:3000",
+            "http://localhost:8080"
+        ]}}, expose_headers=REPLICA_HEADERS)
+
+    replica_options = None
+    if app.config['READ_REPLICA']:
+        replica_options = {
+            "interval": app.config['READ_REPLICA_INTERVAL'],
+            "max_writes": app.config['READ_REPLICA_MAX_WRITES'],
+        }
+    group_commit_options = None
+    if app.config['GROUP_COMMIT']:
+        group_commit_options = {
+            "max_batch": app.config['GROUP_COMMIT_MAX_BATCH'],
+            "max_delay": app.config['GROUP_COMMIT_MAX_DELAY_MS'] / 1000,
+        }
+    app.extensions['router'] = ProfileRouter(
+        app.config['DATABASE_URL'],
+        profile_dir=app.config['PROFILE_DIR'],
+        max_open=app.config['PROFILE_POOL_SIZE'],
+        idle_seconds=app.config['PROFILE_IDLE_SECONDS'],
+        replica_options=replica_options,
+        group_commit_options=group_commit_options,
+    )
+    app.wsgi_app = ProfilePrefixMiddleware(app.wsgi_app)
+    app.register_blueprint(api)
+    return app
+
+@api.before_request
+def resolve_profile():
+    profile = request.environ.get('nourish.profile') or request.headers.get('X-Profile')
+    if profile and not PROFILE_ID.match(profile):
+        return jsonify({"error": "invalid profile id"}), 400
+    g.profile = profile or None
+
+def get_shard():
+    # held for the whole request so eviction can't close it mid-handler
+    if 'shard' not in g:
+        g.shard = current_app.extensions['router'].get(g.profile)
+    return g.shard
+
+@api.teardown_request
+def release_shard(exc):
+    shard = g.pop('shard', None)
+    if shard is not None:
+        shard.release()
+
+@api.errorhandler(InsertTimeout)
+def insert_timeout(e):
+    # the queued row was cancelled, so retrying cannot create a duplicate
+    return jsonify({"error": "insert timed out, not stored; please retry"}), 503
+
+def get_session():
+    """Session on the current profile's database."""
+    return get_shard().session()
+
+def insert_row(obj):
+    """Commit a new row and return it detached, with its id loaded."""
+    shard = get_shard()
+    if shard.committer is not None:
+        return shard.committer.submit(obj)
+    db = shard.session(expire_on_commit=False)
+    try:
+        db.add(obj)
+        db.commit()
+        return obj
+    finally:
+        db.close()
+
+def read_session():
+    """Session for read-only handlers (replica when enabled)."""
+    shard = get_shard()
+    if shard.replica is None:
+        return shard.session()
+    if request.headers.get('X-Read-Primary') == '1':
+        g.read_source = 'primary'
+        return shard.session()
+    db, staleness = shard.replica.session()
+    g.read_source = 'replica'
+    g.replica_staleness = staleness
+    return db
+
+@api.after_request
+def add_replica_headers(resp):
+    source = g.get('read_source')
+    if source:
+        resp.headers['X-Read-Source'] = source
+        if source == 'replica':
+            resp.headers['X-Replica-Staleness'] = f"{g.replica_staleness:.3f}"
+    return resp
+
+@api.get("/api/health")
 def health():
     return jsonify({"ok": True})
 
 # ---- Create ----
-@app.post("/api/checkins")
+@api.post("/api/checkins")
 def create_checkin():
     data = request.get_json() or {}
 
@@ -53,19 +174,13 @@ def create_checkin():
 
     d = date.fromisoformat(data["date"]) if data.get("date") else date.today()
 
-    db = SessionLocal()
-    try:
-        c = CheckIn(date=d, mood=mood, urge=urge, meal_status=meal, note=note)
-        db.add(c)
-        db.commit()
-        out = {
-            "id": c.id, "date": c.date.isoformat(),
-            "mood": c.mood, "urge": c.urge,
-            "meal_status": c.meal_status, "note": c.note
-        }
-        return jsonify(out), 201
-    finally:
-        db.close()
+    c = insert_row(CheckIn(date=d, mood=mood, urge=urge, meal_status=meal, note=note))
+    out = {
+        "id": c.id, "date": c.date.isoformat(),
+        "mood": c.mood, "urge": c.urge,
+        "meal_status": c.meal_status, "note": c.note
+    }
+    return jsonify(out), 201
 
 # ---- Common payload validator for update ----
 def validate_checkin_payload(data, for_update=False):
@@ -109,12 +224,12 @@ def validate_checkin_payload(data, for_update=False):
     return out, None
 
 # ---- Read (list with filters) ----
-@app.get("/api/checkins")
+@api.get("/api/checkins")
 def list_checkins():
     q_date = request.args.get("date")  # YYYY-MM-DD
     limit = min(int(request.args.get("limit", 10)), 50)
 
-    db = SessionLocal()
+    db = read_session()
     try:
         query = db.query(CheckIn)
         if q_date:
@@ -140,14 +255,14 @@ def list_checkins():
         db.close()
 
 # ---- Update ----
-@app.patch("/api/checkins/<int:cid>")
+@api.patch("/api/checkins/<int:cid>")
 def update_checkin(cid):
     data = request.get_json() or {}
     parsed, err = validate_checkin_payload(data, for_update=True)
     if err:
         return jsonify({"error": err[0]}), err[1]
 
-    db = SessionLocal()
+    db = get_session()
     try:
         c = db.get(CheckIn, cid)   # SQLAlchemy 2.x 推荐用法
         if not c:
@@ -164,9 +279,9 @@ def update_checkin(cid):
         db.close()
 
 # ---- Delete ----
-@app.delete("/api/checkins/<int:cid>")
+@api.delete("/api/checkins/<int:cid>")
 def delete_checkin(cid):
-    db = SessionLocal()
+    db = get_session()
     try:
         c = db.get(CheckIn, cid)
         if not c:
@@ -178,9 +293,9 @@ def delete_checkin(cid):
         db.close()
 
 # ---- Summary ----
-@app.get("/api/summary7")
+@api.get("/api/summary7")
 def summary7():
-    db = SessionLocal()
+    db = read_session()
     try:
         today = date.today()
         days = []
@@ -217,7 +332,7 @@ def summary7():
     finally:
         db.close()
 
-@app.get("/api/checkins/month")
+@api.get("/api/checkins/month")
 def month_view():
     try:
         year = int(request.args.get("year"))
@@ -229,7 +344,7 @@ def month_view():
     first_day = date(year, month, 1)
     last_day = date(year, month, monthrange(year, month)[1])
 
-    db = SessionLocal()
+    db = read_session()
     try:
         rows = (db.query(CheckIn)
                   .filter(and_(CheckIn.date >= first_day, CheckIn.date <= last_day))
@@ -272,11 +387,11 @@ def month_view():
         db.close()
 
 # --- Meals --- #
-@app.get("/api/meals")
+@api.get("/api/meals")
 def meals_list():
     q_date = request.args.get("date")
     limit = min(int(request.args.get("limit", 10)), 50)
-    db = SessionLocal()
+    db = read_session()
     query = db.query(Meal)
     if q_date:
         try:
@@ -299,7 +414,7 @@ def meals_list():
     return jsonify(out)
 
 # 创建
-@app.post("/api/meals")
+@api.post("/api/meals")
 def meals_create():
     data = request.get_json() or {}
     try:
@@ -324,22 +439,19 @@ def meals_create():
     if note and len(note) > 500:
         return jsonify({"error":"note too long (max 500)"}), 400
 
-    db = SessionLocal()
-    m = Meal(date=d, meal_type=meal_type, status=status, note=note, duration_sec=duration_sec)
-    db.add(m); db.commit()
+    m = insert_row(Meal(date=d, meal_type=meal_type, status=status, note=note, duration_sec=duration_sec))
     out = {
         "id": m.id, "date": m.date.isoformat(),
         "meal_type": m.meal_type, "status": m.status,
         "duration_sec": m.duration_sec, "note": m.note
     }
-    db.close()
     return jsonify(out), 201
 
 # 更新
-@app.patch("/api/meals/<int:mid>")
+@api.patch("/api/meals/<int:mid>")
 def meals_update(mid):
     data = request.get_json() or {}
-    db = SessionLocal()
+    db = get_session()
     m = db.query(Meal).get(mid)
     if not m:
         db.close()
@@ -391,9 +503,9 @@ def meals_update(mid):
     return jsonify(out)
 
 # 删除
-@app.delete("/api/meals/<int:mid>")
+@api.delete("/api/meals/<int:mid>")
 def meals_delete(mid):
-    db = SessionLocal()
+    db = get_session()
     m = db.query(Meal).get(mid)
     if not m:
         db.close()
@@ -406,9 +518,9 @@ def meals_delete(mid):
 # - completed: 一天中有 breakfast, lunch, dinner 三种都记录了
 # - partial: 一天中有记录，但不是三餐都有
 # - skipped: 一天中没有任何记录
-@app.get("/api/meals/summary7")
+@api.get("/api/meals/summary7")
 def meals_summary7():
-    db = SessionLocal()
+    db = read_session()
     today = date.today()
     days = []
     status_counter = {"completed":0,"partial":0,"skipped":0}
@@ -475,7 +587,7 @@ def meals_summary7():
     })
 
 # 月份视图：返回该月每天的 meals 数量
-@app.get("/api/meals/month")
+@api.get("/api/meals/month")
 def meals_month_view():
     try:
         year = int(request.args.get("year"))
@@ -487,7 +599,7 @@ def meals_month_view():
     first_day = date(year, month, 1)
     last_day = date(year, month, monthrange(year, month)[1])
 
-    db = SessionLocal()
+    db = read_session()
     try:
         rows = (db.query(Meal)
                   .filter(and_(Meal.date >= first_day, Meal.date <= last_day))
@@ -514,10 +626,83 @@ def meals_month_view():
     finally:
         db.close()
     
+# 年度热力图：每天一个字节，按一年中的第几天排列（base64）
+# - checkins / meals: 当天记录数（上限 255）
+# - mood: 当天平均 mood × 10（10..50），0 表示无记录
+# - completion: 当天记录的正餐种类数（0..3，3 = completed）
+HEATMAP_METRICS = ["checkins", "meals", "mood", "completion"]
+HEATMAP_CACHE_SIZE = 16
+
+def heatmap_values(db, year, metric):
+    first_day = date(year, 1, 1)
+    last_day = date(year, 12, 31)
+    if metric in ("checkins", "mood"):
+        value = func.count(CheckIn.id) if metric == "checkins" else func.avg(CheckIn.mood)
+        query = (db.query(CheckIn.date, value)
+                   .filter(and_(CheckIn.date >= first_day, CheckIn.date <= last_day))
+                   .group_by(CheckIn.date))
+    else:
+        value = func.count(Meal.id) if metric == "meals" else func.count(distinct(Meal.meal_type))
+        query = db.query(Meal.date, value).filter(and_(Meal.date >= first_day, Meal.date <= last_day))
+        if metric == "completion":
+            query = query.filter(Meal.meal_type.in_(["breakfast", "lunch", "dinner"]))
+        query = query.group_by(Meal.date)
+
+    values = bytearray(366 if isleap(year) else 365)
+    start = first_day.toordinal()
+    for d, v in query:
+        if v is None:
+            continue
+        if metric == "mood":
+            v = round(v * 10)
+        values[d.toordinal() - start] = min(int(v), 255)
+    return bytes(values)
+
+@api.get("/api/heatmap")
+def heatmap():
+    try:
+        year = int(request.args.get("year"))
+        assert 1 <= year <= 9999
+    except Exception:
+        return jsonify({"error": "year required, e.g. ?year=2025"}), 400
+    metric = request.args.get("metric", "checkins")
+    if metric not in HEATMAP_METRICS:
+        return jsonify({"error": "invalid metric (checkins|meals|mood|completion)"}), 400
+
+    # 缓存到下一次写入为止：版本号由数据库触发器维护，多进程下也一致
+    shard = get_shard()
+    key = (year, metric)
+    db = get_session()
+    try:
+        version = data_version(db)
+        with shard.heatmaps_lock:
+            cached = shard.heatmaps.get(key)
+            if cached:
+                shard.heatmaps.move_to_end(key)
+        if cached and cached[0] == version:
+            values = cached[1]
+        else:
+            values = heatmap_values(db, year, metric)
+            with shard.heatmaps_lock:
+                shard.heatmaps[key] = (version, values)
+                shard.heatmaps.move_to_end(key)
+                while len(shard.heatmaps) > HEATMAP_CACHE_SIZE:
+                    shard.heatmaps.popitem(last=False)
+    finally:
+        db.close()
+
+    resp = jsonify({
+        "year": year, "metric": metric, "days": len(values),
+        "encoding": "base64", "data": base64.b64encode(values).decode("ascii"),
+    })
+    resp.add_etag()
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
 # ---- Resources ----
-@app.get("/api/resources")
+@api.get("/api/resources")
 def resources():
-    db = SessionLocal()
+    db = read_session()
     try:
         items = db.query(Resource).all()
         out = [{"id": r.id, "title": r.title, "url": r.url, "type": r.type, "tags": r.tags} for r in items]
@@ -525,5 +710,7 @@ def resources():
     finally:
         db.close()
 
+app = create_app()
+
 if __name__ == "__main__":
     app.run(port=5001, debug=True)
@@ -0,0 +1,50 @@
+"""
+Compare insert throughput: commit-per-request vs group commit.
+
+    python bench_group_commit.py [threads] [requests_per_thread]
+
+Each mode posts check-ins from concurrent threads through the Flask test
+client against a fresh temporary nourish.db.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import create_app
+
+
+def run(group_commit, threads, per_thread):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app({
+            "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'nourish.db')}",
+            "GROUP_COMMIT": group_commit,
+        })
+        body = json.dumps({"mood": 3, "urge": 1, "meal_status": "completed"})
+
+        def worker(_):
+            client = app.test_client()
+            for _ in range(per_thread):
+                r = client.post('/api/checkins', data=body, content_type='application/json')
+                assert r.status_code == 201, r.data
+
+        app.test_client().get('/api/health')
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(worker, range(threads)))
+        elapsed = time.perf_counter() - t0
+        app.extensions['router'].close_all()
+    return threads * per_thread / elapsed
+
+
+def main(threads=16, per_thread=50):
+    for label, group_commit in (("commit per request", False), ("group commit", True)):
+        rate = run(group_commit, threads, per_thread)
+        print(f"{label:>18}: {rate:7.0f} inserts/s ({threads} threads x {per_thread})")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,52 @@
+"""
+Measure worker boot time: fresh interpreter -> create_app() -> first request.
+
+    python bench_startup.py [runs]
+
+Each run starts a new Python process against a temporary nourish.db, once
+with an empty file (schema created) and then with a current schema (the
+PRAGMA user_version fast path skips DDL).
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BOOT = """
+import time
+t0 = time.perf_counter()
+from app import create_app
+app = create_app()
+t1 = time.perf_counter()
+app.test_client().get('/api/health')
+app.test_client().get('/api/resources')
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t0)
+"""
+
+
+def boot(db_path):
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{db_path}")
+    out = subprocess.run([sys.executable, "-c", BOOT], env=env, check=True,
+                         capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    return [float(x) * 1000 for x in out.stdout.split()]
+
+
+def main(runs=10):
+    cold, warm = [], []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "nourish.db")
+            cold.append(boot(path))
+            warm.append(boot(path))
+    for label, samples in (("empty db", cold), ("current schema", warm)):
+        factory = statistics.median(s[0] for s in samples)
+        first = statistics.median(s[1] for s in samples)
+        print(f"{label:>15}: import+create_app {factory:6.1f} ms, "
+              f"first request {first:6.1f} ms (median of {runs})")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,120 @@
+"""
+Group commit for high-frequency inserts.
+
+Request threads hand new rows to a single writer thread. The writer takes
+whatever has queued up (at most `max_batch` rows) and commits it as one
+transaction straight away; rows arriving during that commit form the next
+batch. The writer never waits for more rows: it drains the queue without
+blocking, for at most `max_delay` seconds. Each caller blocks until the
+transaction holding its row is committed, so one fsync covers the batch.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+_STOP = object()
+
+
+class InsertTimeout(Exception):
+    """The row was not committed in time and has been dropped from the queue."""
+
+
+class GroupCommitter:
+    def __init__(self, session_factory, max_batch=64, max_delay=0.005):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._closing = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, obj, timeout=10):
+        """Insert `obj` and wait until it is committed.
+
+        Returns `obj`, detached with its attributes (including `id`) loaded.
+        Raises whatever the commit raised if the row could not be stored, or
+        InsertTimeout if it was still queued after `timeout` seconds; a
+        timed-out row is cancelled, so it is never stored later.
+        """
+        fut = Future()
+        with self._closing:
+            closed = self._closed
+            if not closed:
+                self._queue.put((obj, fut))
+        if closed:
+            # writer is gone: commit in the calling thread instead
+            self._store([obj])
+            return obj
+        try:
+            fut.result(timeout)
+        except FutureTimeout:
+            if fut.cancel():
+                raise InsertTimeout(f"insert not committed within {timeout}s")
+            # the writer already took it; wait for that commit's outcome
+            fut.result()
+        return obj
+
+    def close(self):
+        """Commit everything already queued, then stop the writer."""
+        with self._closing:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch and time.monotonic() < deadline:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            # skip rows whose caller gave up waiting
+            batch = [(obj, fut) for obj, fut in batch if fut.set_running_or_notify_cancel()]
+            if batch:
+                self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        try:
+            self._store([obj for obj, _ in batch])
+        except Exception:
+            # one bad row shouldn't fail the whole group: retry one by one
+            for obj, fut in batch:
+                try:
+                    self._store([obj])
+                except Exception as e:
+                    fut.set_exception(e)
+                else:
+                    fut.set_result(obj)
+        else:
+            for obj, fut in batch:
+                fut.set_result(obj)
+
+    def _store(self, objs):
+        db = self.session_factory(expire_on_commit=False)
+        try:
+            db.add_all(objs)
+            db.commit()
+            db.expunge_all()
+        except Exception:
+            db.rollback()
+            db.expunge_all()
+            raise
+        finally:
+            db.close()
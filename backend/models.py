@@ -1,11 +1,16 @@
+import os
+import threading
 from datetime import datetime, date
-from sqlalchemy import create_engine, Column, Integer, String, Date, DateTime, Text
+from sqlalchemy import create_engine, event, Column, Integer, String, Date, DateTime, Text
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.sql import func
 
-engine = create_engine("sqlite:///nourish.db", echo=False, future=True)
+DEFAULT_DATABASE_URL = "sqlite:///nourish.db"
+# Bump whenever the tables below change, so existing databases get DDL again.
+SCHEMA_VERSION = 2
+
 Base = declarative_base()
-SessionLocal = sessionmaker(bind=engine, autoflush=False, future=True)
 
 class CheckIn(Base):
     __tablename__ = "checkins"
@@ -34,6 +39,13 @@ class Meal(Base):
     note = Column(Text, nullable=True)                    # 备注
     created_at = Column(DateTime, nullable=False, server_default=func.now())
     
+class DataVersion(Base):
+    """Single-row counter bumped by triggers on every check-in/meal write,
+    so caches in any process can tell when the data changed."""
+    __tablename__ = "data_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
 class Resource(Base):
     __tablename__ = "resources"
     id = Column(Integer, primary_key=True)
@@ -42,4 +54,65 @@ class Resource(Base):
     type = Column(String(24))
     tags = Column(String(200))
 
-Base.metadata.create_all(engine)
+
+def make_engine(url=None):
+    url = url or os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL)
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # one shared connection, otherwise every session sees an empty database
+        return create_engine(url, echo=False, future=True, poolclass=StaticPool,
+                             connect_args={"check_same_thread": False})
+    engine = create_engine(url, echo=False, future=True)
+
+    @event.listens_for(engine, "connect")
+    def use_wal(dbapi_conn, record):
+        # readers (including replica backups) don't block writers in WAL mode
+        dbapi_conn.execute("PRAGMA journal_mode=WAL")
+
+    return engine
+
+def make_session_factory(engine):
+    return sessionmaker(bind=engine, autoflush=False, future=True)
+
+def init_db(engine):
+    """Create tables unless the schema is already at SCHEMA_VERSION.
+
+    The version lives in SQLite's `PRAGMA user_version`, so a current
+    database skips DDL reflection entirely. Returns True if DDL ran.
+    """
+    with engine.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() == SCHEMA_VERSION:
+            return False
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)")
+        for table in ("checkins", "meals"):
+            for op in ("INSERT", "UPDATE", "DELETE"):
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_version "
+                    f"AFTER {op} ON {table} "
+                    "BEGIN UPDATE data_version SET version = version + 1 WHERE id = 1; END"
+                )
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return True
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def data_version(db):
+    """Current check-in/meal data version; changes on every write."""
+    return db.query(DataVersion.version).filter(DataVersion.id == 1).scalar()
+
+def get_engine():
+    """Default engine (DATABASE_URL or nourish.db), created on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = make_engine()
+            init_db(_engine)
+        return _engine
+
+def __getattr__(name):
+    # keeps `from models import engine` working without an import-time engine
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,232 @@
+"""
+Per-profile database routing.
+
+Each recovery profile gets its own SQLite file under `profile_dir`. Engines
+are opened lazily (creating the schema on first use) and kept in an
+LRU-bounded pool; least recently used and idle engines are disposed.
+Requests without a profile use the default database (`nourish.db`).
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from group_commit import GroupCommitter
+from models import make_engine, make_session_factory, init_db
+from replica import ReadReplica
+
+PROFILE_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_PREFIX = re.compile(r"^/p/([^/]+)(/api/.*)$")
+
+
+class Shard:
+    """Engine, session factory, optional read replica and group committer
+    for one profile."""
+
+    def __init__(self, engine, session_factory, replica_options=None,
+                 group_commit_options=None):
+        self.engine = engine
+        self.session = session_factory
+        self.replica = None
+        if replica_options is not None:
+            self.replica = ReadReplica(engine, session_factory, **replica_options)
+        self.committer = None
+        if group_commit_options is not None:
+            self.committer = GroupCommitter(session_factory, **group_commit_options)
+        self.last_used = time.monotonic()
+        # requests in flight; an evicted shard is closed when the last one ends
+        self._users = 0
+        self._retired = False
+        self._state = threading.Lock()
+        # heatmaps for the current data version, least recently used first
+        self.heatmaps = OrderedDict()
+        self.heatmaps_lock = threading.Lock()
+
+    def acquire(self):
+        with self._state:
+            self._users += 1
+
+    def release(self):
+        with self._state:
+            self._users -= 1
+            unused = self._retired and self._users == 0
+        if unused:
+            self.close()
+
+    def retire(self):
+        """Close now if idle, otherwise when the last request releases it."""
+        with self._state:
+            self._retired = True
+            unused = self._users == 0
+        if unused:
+            self.close()
+
+    def close(self):
+        if self.committer is not None:
+            self.committer.close()
+        if self.replica is not None:
+            self.replica.close()
+        self.engine.dispose()
+
+
+class ProfileRouter:
+    def __init__(self, default_url=None, profile_dir="profiles",
+                 max_open=64, idle_seconds=300, replica_options=None,
+                 group_commit_options=None):
+        self.default_url = default_url
+        self.profile_dir = profile_dir
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.replica_options = replica_options
+        self.group_commit_options = group_commit_options
+        self._default = None
+        self._shards = OrderedDict()
+        # profile -> Future for opens in progress, so only one request runs DDL
+        self._opening = {}
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self._shards)
+
+    def __contains__(self, profile):
+        return profile in self._shards
+
+    @property
+    def default(self):
+        """Shard for requests without a profile, opened on first use."""
+        if self._default is None:
+            with self._lock:
+                if self._default is None:
+                    self._default = self._open_url(self.default_url)
+        return self._default
+
+    def get(self, profile=None):
+        """Return the shard for `profile`, opening it if needed.
+
+        The shard is acquired for the caller, who must `release()` it.
+        """
+        if profile is None:
+            shard = self.default
+            shard.acquire()
+            return shard
+        if not PROFILE_ID.match(profile):
+            raise ValueError(f"invalid profile id: {profile!r}")
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                shard = self._shards.get(profile)
+                if shard is not None:
+                    self._shards.move_to_end(profile)
+                    evicted = self._checkout(shard, now)
+                    break
+                opening = self._opening.get(profile)
+                owner = opening is None
+                if owner:
+                    opening = self._opening[profile] = Future()
+                    self._start_sweeper()
+            if not owner:
+                # someone else is opening this profile: wait, then look again
+                opening.result()
+                continue
+            # DDL and engine setup happen outside the lock so lookups for
+            # other profiles aren't stuck behind a cold open
+            try:
+                shard = self._open(profile)
+            except Exception as e:
+                with self._lock:
+                    del self._opening[profile]
+                opening.set_exception(e)
+                raise
+            with self._lock:
+                del self._opening[profile]
+                self._shards[profile] = shard
+                evicted = self._checkout(shard, now)
+            opening.set_result(shard)
+            break
+        for old in evicted:
+            old.retire()
+        return shard
+
+    def _checkout(self, shard, now):
+        # called with the lock held
+        shard.last_used = now
+        shard.acquire()
+        return self._evict(now)
+
+    def sweep(self):
+        """Close engines idle for longer than `idle_seconds`."""
+        with self._lock:
+            evicted = self._evict(time.monotonic())
+        for shard in evicted:
+            shard.retire()
+
+    def _sweep_loop(self):
+        # without this an idle pool would only shrink on the next profile request
+        while not self._stop.wait(max(self.idle_seconds / 2, 1)):
+            self.sweep()
+
+    def _start_sweeper(self):
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_loop,
+                                             name="profile-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _open(self, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{profile}.db")
+        return self._open_url(f"sqlite:///{path}")
+
+    def _open_url(self, url):
+        engine = make_engine(url)
+        init_db(engine)
+        return Shard(engine, make_session_factory(engine), self.replica_options,
+                     self.group_commit_options)
+
+    def _evict(self, now):
+        """Unlink shards over capacity or idle too long, oldest first.
+
+        Called with the lock held; the caller closes the returned shards
+        after releasing it, so a slow close doesn't stall other lookups.
+        """
+        evicted = []
+        while self._shards:
+            profile, shard = next(iter(self._shards.items()))
+            if (len(self._shards) <= self.max_open
+                    and now - shard.last_used < self.idle_seconds):
+                break
+            del self._shards[profile]
+            evicted.append(shard)
+        return evicted
+
+    def close_all(self):
+        self._stop.set()
+        with self._lock:
+            evicted = list(self._shards.values())
+            self._shards.clear()
+            if self._default is not None:
+                evicted.append(self._default)
+                self._default = None
+        for shard in evicted:
+            shard.retire()
+
+
+class ProfilePrefixMiddleware:
+    """WSGI middleware mapping /p/<profile>/api/... to /api/...
+
+    The profile id is stored in the environ as `nourish.profile`.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        m = _PREFIX.match(environ.get("PATH_INFO", ""))
+        if m:
+            environ["nourish.profile"] = m.group(1)
+            environ["SCRIPT_NAME"] = environ.get("SCRIPT_NAME", "") + f"/p/{m.group(1)}"
+            environ["PATH_INFO"] = m.group(2)
+        return self.wsgi_app(environ, start_response)
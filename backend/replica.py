@@ -0,0 +1,175 @@
+"""
+In-memory read replica of the SQLite database.
+
+Heavy read endpoints can be served from a snapshot copied with the SQLite
+online backup API, so they don't compete with writers for the file lock.
+A background thread refreshes the snapshot every `interval` seconds, or
+sooner once `max_writes` commits have landed on the primary. The copy runs
+`backup_pages` pages at a time, so the primary's read lock is only held
+for one step at a time.
+"""
+import itertools
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+_generation = itertools.count(1)
+
+
+class _Snapshot:
+    """One in-memory copy, kept alive until it is retired and unused."""
+
+    def __init__(self, connect, keeper, refreshed_at):
+        # NullPool: each session gets its own connection, closed with it
+        self.engine = create_engine("sqlite://", creator=connect,
+                                    poolclass=NullPool, future=True)
+        self.keeper = keeper
+        self.refreshed_at = refreshed_at
+        self.users = 0
+        self.retired = False
+
+    def close(self):
+        self.engine.dispose()
+        self.keeper.close()
+
+
+class _SnapshotSession(Session):
+    """Session pinned to one snapshot connection; closing it drops the
+    snapshot reference."""
+
+    def __init__(self, replica, snapshot, conn):
+        super().__init__(bind=conn, autoflush=False)
+        self._replica = replica
+        self._snapshot_ref = snapshot
+        self._conn = conn
+
+    def close(self):
+        super().close()
+        if self._snapshot_ref is not None:
+            snapshot, self._snapshot_ref = self._snapshot_ref, None
+            self._conn.close()
+            self._replica._release(snapshot)
+
+
+class ReadReplica:
+    def __init__(self, engine, session_factory, interval=2.0, max_writes=20,
+                 backup_pages=256, step_sleep=0.001):
+        self.primary = engine
+        self.interval = interval
+        self.max_writes = max_writes
+        self.backup_pages = backup_pages
+        self.step_sleep = step_sleep
+        self._lock = threading.Lock()
+        # guards the current snapshot and every snapshot's user count
+        self._state = threading.Lock()
+        self._snapshot = None
+        self._pending_writes = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        event.listen(session_factory, "after_commit", self._on_commit)
+
+    def _on_commit(self, session):
+        self._pending_writes += 1
+        if self._pending_writes >= self.max_writes:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            with self._lock:
+                self.refresh()
+
+    @property
+    def staleness(self):
+        """Seconds since the current snapshot was taken."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        return time.monotonic() - snapshot.refreshed_at
+
+    def is_stale(self):
+        return (self._snapshot is None
+                or self.staleness >= self.interval
+                or self._pending_writes >= self.max_writes)
+
+    def refresh(self):
+        """Copy the primary database into a fresh in-memory snapshot."""
+        uri = f"file:nourish_replica_{next(_generation)}?mode=memory&cache=shared"
+
+        def connect():
+            return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+        # keeps the in-memory database alive while the snapshot is in use
+        keeper = connect()
+        refreshed_at = time.monotonic()
+        self._pending_writes = 0
+        def pause(status, remaining, total):
+            # let writers in between steps
+            if remaining:
+                time.sleep(self.step_sleep)
+
+        src = self.primary.raw_connection()
+        try:
+            src.driver_connection.backup(keeper, pages=self.backup_pages, progress=pause)
+        finally:
+            src.close()
+
+        self._swap(_Snapshot(connect, keeper, refreshed_at))
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._swap(None)
+
+    def _swap(self, snapshot):
+        with self._state:
+            old, self._snapshot = self._snapshot, snapshot
+            if old is None:
+                return
+            old.retired = True
+            unused = old.users == 0
+        if unused:
+            old.close()
+
+    def _release(self, snapshot):
+        with self._state:
+            snapshot.users -= 1
+            unused = snapshot.retired and snapshot.users == 0
+        if unused:
+            snapshot.close()
+
+    def session(self):
+        """Return (session, staleness) for a read-only handler.
+
+        Only the first call copies the database; after that the background
+        thread refreshes it and readers never wait for a copy. The session
+        holds its snapshot open until it is closed, even if a refresh
+        replaces it in the meantime.
+        """
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self.refresh()
+                    self._thread = threading.Thread(target=self._run,
+                                                    name="read-replica", daemon=True)
+                    self._thread.start()
+        with self._state:
+            snapshot = self._snapshot
+            snapshot.users += 1
+        try:
+            conn = snapshot.engine.connect()
+        except Exception:
+            self._release(snapshot)
+            raise
+        db = _SnapshotSession(self, snapshot, conn)
+        return db, time.monotonic() - snapshot.refreshed_at
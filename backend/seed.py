@@ -1,7 +1,7 @@
-from models import SessionLocal, Resource, CheckIn
+from models import Resource, CheckIn, get_engine, make_session_factory
 from datetime import date, timedelta
 
-session = SessionLocal()
+session = make_session_factory(get_engine())()
 
 # Reset tables (simple demo way)
 session.query(Resource).delete()
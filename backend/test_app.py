@@ -3,38 +3,35 @@ Backend API Tests
 Tests for core functionality of the NourishSteps API
 """
 import pytest
+import base64
 import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
-from app import app
-from models import SessionLocal, CheckIn, Meal, Base, engine
+from app import create_app, HEATMAP_CACHE_SIZE
+from group_commit import GroupCommitter, InsertTimeout
+from models import make_engine, make_session_factory, init_db, CheckIn, Meal
+from replica import ReadReplica
 
 @pytest.fixture
-def client():
-    """Create a test client"""
-    app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
-
-@pytest.fixture
-def db_session():
-    """Create a test database session"""
-    Base.metadata.create_all(engine)
-    session = SessionLocal()
-    yield session
-    session.rollback()
-    session.close()
+def make_client(tmp_path):
+    """Build test clients on a private in-memory database"""
+    apps = []
+    def make(**config):
+        app = create_app({"TESTING": True, "DATABASE_URL": "sqlite://",
+                          "PROFILE_DIR": str(tmp_path / "profiles"), **config})
+        apps.append(app)
+        return app.test_client()
+    yield make
+    for app in apps:
+        app.extensions['router'].close_all()
 
 @pytest.fixture
-def cleanup_db():
-    """Clean up test data"""
-    yield
-    db = SessionLocal()
-    try:
-        db.query(CheckIn).delete()
-        db.query(Meal).delete()
-        db.commit()
-    finally:
-        db.close()
+def client(make_client):
+    """Create a test client"""
+    return make_client()
 
 class TestHealth:
     """Test health check endpoint"""
@@ -47,7 +44,7 @@ class TestHealth:
 class TestCheckIns:
     """Test check-in endpoints"""
     
-    def test_create_checkin(self, client, cleanup_db):
+    def test_create_checkin(self, client):
         data = {
             "date": date.today().isoformat(),
             "mood": 4,
@@ -72,7 +69,7 @@ class TestCheckIns:
                              content_type='application/json')
         assert response.status_code == 400
     
-    def test_list_checkins(self, client, cleanup_db):
+    def test_list_checkins(self, client):
         # Create a test check-in
         data = {
             "date": date.today().isoformat(),
@@ -91,7 +88,7 @@ class TestCheckIns:
         assert isinstance(result, list)
         assert len(result) > 0
     
-    def test_summary7(self, client, cleanup_db):
+    def test_summary7(self, client):
         # Create some test check-ins
         for i in range(3):
             data = {
@@ -115,7 +112,7 @@ class TestCheckIns:
 class TestMeals:
     """Test meal endpoints"""
     
-    def test_create_meal(self, client, cleanup_db):
+    def test_create_meal(self, client):
         data = {
             "date": date.today().isoformat(),
             "meal_type": "breakfast",
@@ -128,7 +125,7 @@ class TestMeals:
         result = json.loads(response.data)
         assert result['meal_type'] == 'breakfast'
     
-    def test_list_meals(self, client, cleanup_db):
+    def test_list_meals(self, client):
         # Create test meals
         for meal_type in ["breakfast", "lunch", "dinner"]:
             data = {
@@ -146,7 +143,7 @@ class TestMeals:
         assert isinstance(result, list)
         assert len(result) == 3
     
-    def test_meals_summary7(self, client, cleanup_db):
+    def test_meals_summary7(self, client):
         # Create meals for different days
         for i in range(3):
             data = {
@@ -165,3 +162,307 @@ class TestMeals:
         assert 'meals' in result
         assert 'streak' in result
 
+
+class TestReadReplica:
+    """Test the in-memory read replica"""
+
+    @pytest.fixture
+    def client(self, make_client):
+        return make_client(READ_REPLICA=True, READ_REPLICA_INTERVAL=60,
+                           READ_REPLICA_MAX_WRITES=2)
+
+    def test_reads_served_from_snapshot(self, client):
+        response = client.get('/api/checkins')
+        assert response.headers['X-Read-Source'] == 'replica'
+        assert float(response.headers['X-Replica-Staleness']) >= 0
+        assert json.loads(response.data) == []
+
+        data = {"mood": 3, "urge": 1, "meal_status": "partial"}
+        client.post('/api/checkins', data=json.dumps(data),
+                    content_type='application/json')
+        # one write is below max_writes, so the snapshot is still served
+        response = client.get('/api/checkins')
+        assert json.loads(response.data) == []
+
+        client.post('/api/checkins', data=json.dumps(data),
+                    content_type='application/json')
+        # max_writes reached: the background thread takes a new snapshot
+        for _ in range(100):
+            response = client.get('/api/checkins')
+            if json.loads(response.data):
+                break
+            time.sleep(0.02)
+        assert len(json.loads(response.data)) == 2
+
+    def test_force_primary_read(self, client):
+        client.get('/api/checkins')
+        data = {"mood": 3, "urge": 1, "meal_status": "partial"}
+        client.post('/api/checkins', data=json.dumps(data),
+                    content_type='application/json')
+        response = client.get('/api/checkins', headers={'X-Read-Primary': '1'})
+        assert response.headers['X-Read-Source'] == 'primary'
+        assert 'X-Replica-Staleness' not in response.headers
+        assert len(json.loads(response.data)) > 0
+
+    def test_refresh_keeps_open_sessions_working(self, tmp_path):
+        engine = make_engine(f"sqlite:///{tmp_path / 'nourish.db'}")
+        init_db(engine)
+        replica = ReadReplica(engine, make_session_factory(engine), interval=60)
+
+        db, _ = replica.session()
+        assert db.query(CheckIn).count() == 0
+        old = replica._snapshot
+        # another thread replaces the snapshot mid-request
+        t = threading.Thread(target=replica.refresh)
+        t.start(); t.join()
+        assert replica._snapshot is not old
+        assert db.query(CheckIn).count() == 0
+        db.close()
+
+        # a session created before its first query survives a refresh too
+        db, _ = replica.session()
+        replica.refresh()
+        assert db.query(CheckIn).count() == 0
+        db.close()
+        replica.close()
+        engine.dispose()
+
+    def test_refresh_runs_in_background(self, tmp_path):
+        engine = make_engine(f"sqlite:///{tmp_path / 'nourish.db'}")
+        init_db(engine)
+        factory = make_session_factory(engine)
+        replica = ReadReplica(engine, factory, interval=60, max_writes=1, backup_pages=1)
+        db, _ = replica.session()
+        db.close()
+        first = replica._snapshot
+
+        db = factory()
+        db.add(CheckIn(date=date.today(), mood=3, urge=0, meal_status="partial"))
+        db.commit()
+        db.close()
+        for _ in range(100):
+            if replica._snapshot is not first:
+                break
+            time.sleep(0.02)
+        db, _ = replica.session()
+        assert db.query(CheckIn).count() == 1
+        db.close()
+        replica.close()
+        engine.dispose()
+
+class TestProfiles:
+    """Test per-profile database routing"""
+
+    @pytest.fixture
+    def client(self, make_client):
+        return make_client(PROFILE_POOL_SIZE=2)
+
+    @pytest.fixture
+    def router(self, client):
+        return client.application.extensions['router']
+
+    def test_profiles_are_isolated(self, client):
+        data = {"mood": 4, "urge": 0, "meal_status": "completed"}
+        response = client.post('/api/checkins', data=json.dumps(data),
+                               content_type='application/json',
+                               headers={'X-Profile': 'alice'})
+        assert response.status_code == 201
+
+        response = client.get('/api/checkins', headers={'X-Profile': 'bob'})
+        assert json.loads(response.data) == []
+        # URL prefix selects the same profile as the header
+        response = client.get('/p/alice/api/checkins')
+        assert len(json.loads(response.data)) == 1
+
+    def test_lru_pool_is_bounded(self, client, router):
+        for profile in ["a", "b", "c"]:
+            client.get('/api/meals', headers={'X-Profile': profile})
+        assert len(router) == 2
+        assert "a" not in router
+        # evicted profiles reopen from their file
+        response = client.get('/p/a/api/meals')
+        assert response.status_code == 200
+
+    def test_sweep_closes_idle_engines(self, client, router):
+        client.get('/api/meals', headers={'X-Profile': 'a'})
+        assert "a" in router
+        router._shards["a"].last_used -= router.idle_seconds
+        router.sweep()
+        assert len(router) == 0
+
+    def test_cold_open_does_not_block_open_profiles(self, client, router):
+        client.get('/api/meals', headers={'X-Profile': 'warm'})
+        started, unblock = threading.Event(), threading.Event()
+        real_open = router._open
+
+        def slow_open(profile):
+            started.set()
+            unblock.wait(5)
+            return real_open(profile)
+
+        router._open = slow_open
+        opener = threading.Thread(target=lambda: router.get('cold').release())
+        opener.start()
+        try:
+            assert started.wait(5)
+            t0 = time.monotonic()
+            router.get('warm').release()
+            assert time.monotonic() - t0 < 1
+        finally:
+            unblock.set()
+            opener.join()
+        assert 'cold' in router
+
+    def test_invalid_profile(self, client):
+        response = client.get('/api/checkins', headers={'X-Profile': '../etc'})
+        assert response.status_code == 400
+
+class TestSchema:
+    """Test lazy engine setup and the schema-version fast path"""
+
+    def test_init_db_skips_current_schema(self, tmp_path):
+        engine = make_engine(f"sqlite:///{tmp_path / 'nourish.db'}")
+        assert init_db(engine) is True
+        assert init_db(engine) is False
+        engine.dispose()
+
+    def test_create_app_is_lazy(self, tmp_path):
+        path = tmp_path / "lazy.db"
+        app = create_app({"DATABASE_URL": f"sqlite:///{path}"})
+        assert not path.exists()
+        app.test_client().get('/api/resources')
+        assert path.exists()
+        app.extensions['router'].close_all()
+
+class TestGroupCommit:
+    """Test the group-commit insert path"""
+
+    @pytest.fixture
+    def client(self, make_client, tmp_path):
+        return make_client(DATABASE_URL=f"sqlite:///{tmp_path / 'nourish.db'}",
+                           GROUP_COMMIT=True, GROUP_COMMIT_MAX_DELAY_MS=20)
+
+    def test_concurrent_inserts_get_their_own_ids(self, client):
+        def post(i):
+            data = {"meal_type": "snack", "status": "completed", "duration_sec": i}
+            return client.application.test_client().post(
+                '/api/meals', data=json.dumps(data), content_type='application/json')
+
+        with ThreadPoolExecutor(8) as pool:
+            responses = list(pool.map(post, range(20)))
+        assert all(r.status_code == 201 for r in responses)
+        results = [json.loads(r.data) for r in responses]
+        assert len({r['id'] for r in results}) == 20
+        assert sorted(r['duration_sec'] for r in results) == list(range(20))
+
+        response = client.get('/api/meals?limit=50')
+        assert len(json.loads(response.data)) == 20
+
+    def test_checkin_is_visible_after_201(self, client):
+        data = {"mood": 4, "urge": 1, "meal_status": "completed"}
+        response = client.post('/api/checkins', data=json.dumps(data),
+                               content_type='application/json')
+        assert response.status_code == 201
+        cid = json.loads(response.data)['id']
+        response = client.get('/api/checkins')
+        assert [c['id'] for c in json.loads(response.data)] == [cid]
+
+    def test_evicted_shard_stays_open_for_inflight_insert(self, make_client):
+        client = make_client(GROUP_COMMIT=True, PROFILE_POOL_SIZE=1)
+        router = client.application.extensions['router']
+        shard = router.get("a")
+        router.get("b").release()  # evicts "a" while it is still in use
+        assert "a" not in router
+        m = shard.committer.submit(Meal(date=date.today(), meal_type="lunch"))
+        assert m.id is not None
+        shard.release()
+        assert shard.committer._closed
+
+    def test_timed_out_insert_is_never_stored(self, tmp_path):
+        engine = make_engine(f"sqlite:///{tmp_path / 'nourish.db'}")
+        init_db(engine)
+        factory = make_session_factory(engine)
+        writer_busy, unblock = threading.Event(), threading.Event()
+
+        def slow_factory(**kw):
+            # hold the writer inside the first commit
+            if not writer_busy.is_set():
+                writer_busy.set()
+                unblock.wait(5)
+            return factory(**kw)
+
+        committer = GroupCommitter(slow_factory)
+        first = threading.Thread(target=committer.submit,
+                                 args=(Meal(date=date.today(), meal_type="breakfast"),))
+        first.start()
+        assert writer_busy.wait(5)
+        with pytest.raises(InsertTimeout):
+            committer.submit(Meal(date=date.today(), meal_type="lunch"), timeout=0.01)
+        unblock.set()
+        first.join()
+        committer.close()
+        db = factory()
+        assert [m.meal_type for m in db.query(Meal)] == ["breakfast"]
+        db.close()
+        engine.dispose()
+
+class TestHeatmap:
+    """Test the year heatmap endpoint"""
+
+    def post(self, client, path, data):
+        client.post(path, data=json.dumps(data), content_type='application/json')
+
+    def decode(self, response):
+        return list(base64.b64decode(json.loads(response.data)['data']))
+
+    def test_heatmap_metrics(self, client):
+        self.post(client, '/api/checkins', {"date": "2024-01-02", "mood": 4, "urge": 0, "meal_status": "completed"})
+        self.post(client, '/api/checkins', {"date": "2024-01-02", "mood": 3, "urge": 0, "meal_status": "partial"})
+        for meal_type in ["breakfast", "lunch", "dinner", "snack"]:
+            self.post(client, '/api/meals', {"date": "2024-12-31", "meal_type": meal_type})
+
+        response = client.get('/api/heatmap?year=2024&metric=checkins')
+        assert response.status_code == 200
+        result = json.loads(response.data)
+        assert result['days'] == 366
+        values = self.decode(response)
+        assert len(values) == 366
+        assert values[1] == 2 and sum(values) == 2
+
+        assert self.decode(client.get('/api/heatmap?year=2024&metric=mood'))[1] == 35
+        assert self.decode(client.get('/api/heatmap?year=2024&metric=meals'))[365] == 4
+        assert self.decode(client.get('/api/heatmap?year=2024&metric=completion'))[365] == 3
+        assert json.loads(client.get('/api/heatmap?year=2023').data)['days'] == 365
+
+    def test_heatmap_cached_until_write(self, client):
+        response = client.get('/api/heatmap?year=2024')
+        etag = response.headers['ETag']
+        response = client.get('/api/heatmap?year=2024', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+        self.post(client, '/api/checkins', {"date": "2024-03-01", "mood": 3, "urge": 0})
+        response = client.get('/api/heatmap?year=2024', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert self.decode(response)[60] == 1
+
+    def test_heatmap_cache_is_bounded(self, client):
+        for year in range(2000, 2000 + HEATMAP_CACHE_SIZE + 5):
+            client.get(f'/api/heatmap?year={year}')
+        shard = client.application.extensions['router'].default
+        assert len(shard.heatmaps) == HEATMAP_CACHE_SIZE
+
+    def test_heatmap_sees_writes_from_other_processes(self, make_client, tmp_path):
+        path = tmp_path / 'nourish.db'
+        client = make_client(DATABASE_URL=f"sqlite:///{path}")
+        assert self.decode(client.get('/api/heatmap?year=2024'))[0] == 0
+        # a write made outside this app, e.g. by another gunicorn worker
+        conn = sqlite3.connect(path)
+        conn.execute("INSERT INTO checkins (date, mood, urge, meal_status) "
+                     "VALUES ('2024-01-01', 3, 0, 'skipped')")
+        conn.commit()
+        conn.close()
+        assert self.decode(client.get('/api/heatmap?year=2024'))[0] == 1
+
+    def test_heatmap_validation(self, client):
+        assert client.get('/api/heatmap').status_code == 400
+        assert client.get('/api/heatmap?year=2024&metric=steps').status_code == 400
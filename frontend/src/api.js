@@ -120,3 +120,14 @@ export async function getMealsMonth(year, month){
   return request(`/api/meals/month${qs({ year, month })}`);
 }
 
+
+/* -------------------------------
+ * Heatmap
+ * ----------------------------- */
+
+/** 一年的每日数值（数组下标 = 一年中的第几天 - 1） */
+export async function getHeatmap(year, metric = "checkins") {
+  const res = await request(`/api/heatmap${qs({ year, metric })}`);
+  const raw = atob(res.data);
+  return { ...res, values: Array.from(raw, (ch) => ch.charCodeAt(0)) };
+}